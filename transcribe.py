@@ -4,16 +4,37 @@
 
 # TODO: try API v2 or other models; see which has the best results.
 
-import os
+import json
+import queue
+import subprocess
 import sys
-import tempfile
-from pydub import AudioSegment
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 from google.cloud import speech
 from google.cloud import storage
 
 bucket_name = "concord_consortium_audio_transcriber"
+upload_chunk_size = 8 * 1024 * 1024  # must be a multiple of 256 KB
 storage_client = storage.Client()
+speech_client = speech.SpeechClient()
+
+# The recognition settings never change, so build them once
+recognition_config = speech.RecognitionConfig(
+    encoding=speech.RecognitionConfig.AudioEncoding.FLAC,
+    sample_rate_hertz=16000,
+    audio_channel_count=1,
+    model="latest_long",
+    enable_automatic_punctuation=True,
+    enable_word_time_offsets=True,
+    language_code="en-US",
+    diarization_config=speech.SpeakerDiarizationConfig(
+        enable_speaker_diarization=True,
+        min_speaker_count=1,
+        max_speaker_count=5,
+    ),
+)
 
 
 def usage():
@@ -35,25 +56,107 @@ except IOError:
 
 #### Google API methods ####
 
-def convert_to_flac(audio_file_path, temp_flac_file):
-    """Converts an audio file to FLAC format."""
-    flac_file_path = temp_flac_file.name
+class PipeReader:
+    """Wraps a pipe so it can be streamed by the Cloud Storage uploader.
+
+    A background thread keeps reading the pipe into a bounded queue, so
+    FFmpeg can carry on encoding while the previous chunk is being sent.
+    Resumable uploads also track their progress with tell(), which pipes
+    don't support, so we count the bytes read ourselves.
+    """
+
+    def __init__(self, pipe, chunk_size=4 * 1024 * 1024, max_chunks=4):
+        self.chunks = queue.Queue(maxsize=max_chunks)
+        self.buffer = bytearray()
+        self.position = 0
+        self.at_eof = False
+        threading.Thread(target=self.pump, args=(pipe, chunk_size), daemon=True).start()
+
+    def pump(self, pipe, chunk_size):
+        try:
+            while chunk := pipe.read(chunk_size):
+                self.chunks.put(chunk)
+        finally:
+            # An empty chunk marks the end of the stream
+            self.chunks.put(b"")
+
+    def read(self, size=-1):
+        while not self.at_eof and (size < 0 or len(self.buffer) < size):
+            chunk = self.chunks.get()
+            if chunk:
+                self.buffer += chunk
+            else:
+                self.at_eof = True
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        return self.position
+
+
+def probe_audio(audio_file_path):
+    """Returns the container format, codec, sample rate, and channel count of an audio file."""
+    output = subprocess.check_output(
+        ["ffprobe", "-v", "error", "-select_streams", "a:0",
+         "-show_format", "-show_streams", "-of", "json", audio_file_path]
+    )
+    info = json.loads(output)
+    stream = info["streams"][0] if info.get("streams") else {}
+    sample_rate = stream.get("sample_rate")
+    return (
+        info.get("format", {}).get("format_name"),
+        stream.get("codec_name"),
+        int(sample_rate) if sample_rate else None,
+        stream.get("channels"),
+    )
+
+
+def convert_to_flac(audio_file_path) -> subprocess.Popen:
+    """Starts converting an audio file to 16 kHz mono FLAC; the result is on the process's stdout."""
     sys.stderr.write(f"Converting audio to FLAC...\n")
-    audio = AudioSegment.from_file(audio_file_path)
-    audio.export(flac_file_path, format="flac")
-    return temp_flac_file
+    return subprocess.Popen(
+        ["ffmpeg", "-nostdin", "-loglevel", "error", "-i", audio_file_path,
+         "-map", "0:a:0", "-f", "flac", "-c:a", "flac",
+         "-ar", "16000", "-ac", "1", "-sample_fmt", "s16", "pipe:1"],
+        stdout=subprocess.PIPE,
+    )
 
 
-def upload_file_to_bucket(file) -> str:
-    """Uploads a file to the Google Cloud Storage bucket, returns URL"""
-    filename = os.path.basename(file.name)
+def upload_stream_to_bucket(stream, filename) -> str:
+    """Uploads a stream of FLAC data to the Google Cloud Storage bucket, returns URL"""
     print(f"Uploading to Google Cloud...")
     bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(filename)
-    blob.upload_from_filename(file.name)
+    # Upload in chunks so a transient error only retries the current chunk.
+    # Uploads are only retried when conditional; the name is a fresh uuid, so
+    # requiring that the blob doesn't exist yet is always safe.
+    blob = bucket.blob(filename, chunk_size=upload_chunk_size)
+    blob.upload_from_file(
+        stream, content_type="audio/flac", rewind=False, if_generation_match=0
+    )
     return f"gs://{bucket_name}/{filename}"
 
 
+def upload_flac_to_bucket(audio_file_path) -> str:
+    """Uploads the audio to the bucket as FLAC, converting it if needed; returns URL"""
+    filename = f"{uuid.uuid4().hex}.flac"
+    if probe_audio(audio_file_path) == ("flac", "flac", 16000, 1):
+        # Already in the format we ask the recognizer for, so skip the re-encode
+        with open(audio_file_path, "rb") as flac_file:
+            return upload_stream_to_bucket(flac_file, filename)
+
+    # Stream FFmpeg's output straight into the bucket
+    with convert_to_flac(audio_file_path) as ffmpeg:
+        cloud_url = upload_stream_to_bucket(PipeReader(ffmpeg.stdout), filename)
+    if ffmpeg.returncode != 0:
+        remove_file_from_bucket(cloud_url)
+        raise subprocess.CalledProcessError(ffmpeg.returncode, ffmpeg.args)
+    return cloud_url
+
+
 def remove_file_from_bucket(url):
     """Removes a file from the Google Cloud Storage bucket given its URL."""
     parsed_url = urlparse(url)
@@ -69,21 +172,8 @@ def remove_file_from_bucket(url):
 def transcribe_url(uri) -> speech.RecognizeResponse:
     """Submits the transcription job to the Google Speech-to-Text API."""
     sys.stderr.write(f"Transcribing audio...\n")
-    client = speech.SpeechClient()
     audio = speech.RecognitionAudio(uri=uri)
-    speaker_diarization_config = speech.SpeakerDiarizationConfig(
-        enable_speaker_diarization=True,
-        min_speaker_count=1,
-        max_speaker_count=5,
-    )
-    config = speech.RecognitionConfig(
-        encoding=speech.RecognitionConfig.AudioEncoding.FLAC,
-        model="latest_long",
-        enable_automatic_punctuation=True,
-        language_code="en-US",
-        diarization_config=speaker_diarization_config,
-    )
-    operation = client.long_running_recognize(config=config, audio=audio)
+    operation = speech_client.long_running_recognize(config=recognition_config, audio=audio)
     response = operation.result(timeout=1800)  # Allow up to 30 minutes
     return response
 
@@ -92,13 +182,16 @@ def format_duration(seconds):
     """Formats a duration in seconds into HH:MM:SS format."""
     hours, remainder = divmod(seconds, 3600)
     minutes, seconds = divmod(remainder, 60)
+    if isinstance(seconds, int):
+        # Whole seconds (what the transcript passes in); no float formatting needed
+        return f"{hours:02d}:{minutes:02d}:{seconds:02d}.000"
     return f"{int(hours):02}:{int(minutes):02}:{seconds:06.3f}"
 
 
-def print_transcript_line(time, speaker, text):
-    """Prints a line of the transcript with the time, speaker, and text."""
-    if text != "":
-        print(f"{format_duration(time)};{speaker};{text}")
+def add_transcript_line(lines, time, speaker, words):
+    """Adds a line of the transcript with the time, speaker, and words."""
+    if words:
+        lines.append(f"{format_duration(time)};{speaker};{' '.join(words)}")
 
 def print_transcript(response: speech.RecognizeResponse):
     """Prints the transcript from the Google Speech-to-Text API response."""
@@ -113,34 +206,39 @@ def print_transcript(response: speech.RecognizeResponse):
     # Each of the words has fields "word", "speaker_tag" and "speaker_label"
     # (which are essentially the same), "start_time" and "end_time".
 
-    # Header row
-    print("Time;Speaker;Text")
+    # Collect the output and write it all at once at the end, starting with
+    # the header row
+    lines = ["Time;Speaker;Text"]
 
     current_time = None
     current_speaker = None
-    current_text = ""
+    current_words = []
     for word in response.results[-1].alternatives[0].words:
         if word.speaker_label != current_speaker:
             # New speaker identified; start a new line of output
-            print_transcript_line(current_time, current_speaker, current_text)
-            current_text = ""
+            add_transcript_line(lines, current_time, current_speaker, current_words)
+            current_words = []
             current_time = word.start_time.seconds
             current_speaker = word.speaker_label
-        current_text += word.word + " "
-    # print the last line
-    print_transcript_line(current_time, current_speaker, current_text)
+        current_words.append(word.word)
+    # add the last line
+    add_transcript_line(lines, current_time, current_speaker, current_words)
+    sys.stdout.write("\n".join(lines) + "\n")
 
 
 #### Main ####
 
-# Create a temp file for the FLAC audio
-with tempfile.NamedTemporaryFile(suffix=".flac", delete=True) as temp_flac_file:
-
-    flac_file = convert_to_flac(audio_file_path, temp_flac_file)
+cloud_url = upload_flac_to_bucket(audio_file_path)
+with ThreadPoolExecutor(max_workers=1) as executor:
     try:
-        cloud_url = upload_file_to_bucket(flac_file)
         response = transcribe_url(cloud_url)
+    except BaseException:
+        # Nothing to print, so just delete the upload (reporting any failure)
+        remove_file_from_bucket(cloud_url)
+        raise
+    # The upload is no longer needed; delete it while the transcript prints
+    removal = executor.submit(remove_file_from_bucket, cloud_url)
+    try:
         print_transcript(response)
     finally:
-       remove_file_from_bucket(cloud_url)
-
+        removal.result()